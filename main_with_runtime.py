@@ -128,6 +128,11 @@ parser.add_argument('--save_weights_to_disk', action='store_true',
                     help='Save weights to disk')
 parser.add_argument('--stash_to_cpu', action='store_true',
                     help='Stash weights to CPU')
+parser.add_argument('--stash_bf16', action='store_true',
+                    help='Stash the stale weight versions in bf16, the latest weights are kept in fp32 '
+                         'on the device (one extra parameter-sized buffer)')
+parser.add_argument('--shard_stash', action='store_true',
+                    help='Shard the stashed weight versions across the data parallel ranks of a stage')
 parser.add_argument('--clip_grad', default=None, type=float,
                     help='Clip gradient norm using this value')
 parser.add_argument('--deterministic', action='store_true',
@@ -143,6 +148,13 @@ parser.add_argument('--n_head', default=6, type=int,
                     metavar='N', help='number of heads (default: 6)')
 parser.add_argument('--n_layer', default=6, type=int,
                     metavar='N', help='number of layers (default: 6)')
+parser.add_argument('--compile_mode', default=None, type=str, choices=["default", "max-autotune"],
+                    help='torch.compile mode for the transformer blocks of the mid stages, "default" compiles '
+                         'each block, "max-autotune" the whole stack (default: eager)')
+parser.add_argument('--bf16_autocast', action='store_true',
+                    help='Run the transformer blocks of the mid stages under bf16 autocast')
+parser.add_argument('--cuda_graph', action='store_true',
+                    help='Replay the validation forward of the mid stages from a CUDA graph')
 
 best_loss = 100
 _tb = None
@@ -211,12 +223,19 @@ def main():
     # define loss function (criterion)
     criterion = nn.CrossEntropyLoss()
     
+    if args.compile_mode == "max-autotune":
+        # let inductor autotune TF32 GEMMs, this applies to every fp32 matmul
+        # of the process, not only the compiled stack
+        torch.set_float32_matmul_precision('high')
+
     # create stages of the model
     module = importlib.import_module(args.module)
     args.arch = module.arch()
     if args.arch == "gptn":
         model = module.model(criterion, vocab_size=vocab_size, block_size=args.block_size, 
-                         n_embd=args.n_embd, n_head=args.n_head, n_layer=args.n_layer)
+                         n_embd=args.n_embd, n_head=args.n_head, n_layer=args.n_layer,
+                         compile_mode=args.compile_mode, autocast=args.bf16_autocast,
+                         cuda_graph=args.cuda_graph)
     else:
         raise Exception("Invalid model name")
 
@@ -284,6 +303,12 @@ def main():
         model_type=runtime.LANGUAGE_MODELING,
         enable_recompute=args.recompute)
 
+    if args.compile_mode is not None:
+        for module in r.modules():
+            module = getattr(module, "module", module) # unwrap DDP
+            if hasattr(module, "warmup"):
+                module.warmup(args.batch_size)
+
     # stage needed to determine if current stage is the first stage
     # num_stages needed to determine if current stage is the last stage
     # num_ranks needed to determine number of warmup_minibatches in case of pipelining
@@ -338,7 +363,9 @@ def main():
                                           verbose_freq=args.verbose_frequency,
                                           macrobatch=args.macrobatch,
                                           clip_grad=args.clip_grad, save_dir=args.optim_save_dir,
-                                          stash_to_cpu=args.stash_to_cpu)
+                                          stash_to_cpu=args.stash_to_cpu,
+                                          stash_dtype=torch.bfloat16 if args.stash_bf16 else None,
+                                          stash_group=r.group if args.shard_stash else None)
     elif args.optimizer == "nadamw":
         optimizer = nadamw.NAdamWithWeightStashing(r.modules(), r.master_parameters,
                                           r.model_parameters, loss_scale=args.loss_scale,
@@ -348,7 +375,9 @@ def main():
                                           verbose_freq=args.verbose_frequency,
                                           macrobatch=args.macrobatch, 
                                           clip_grad=args.clip_grad, save_dir=args.optim_save_dir,
-                                          stash_to_cpu=args.stash_to_cpu)
+                                          stash_to_cpu=args.stash_to_cpu,
+                                          stash_dtype=torch.bfloat16 if args.stash_bf16 else None,
+                                          stash_group=r.group if args.shard_stash else None)
     else:
         raise Exception("Invalid optimizer")
 
@@ -4,30 +4,123 @@ import torch.nn.functional as F
 
 from .util import Block
 
+# cudagraph trees only replay once the backwards of the previous replays have
+# run, with recompute and 1F1B several forwards are always pending so they
+# would never replay. max-autotune is compiled without CUDA graphs.
+_COMPILE_MODES = {"default": "default", "max-autotune": "max-autotune-no-cudagraphs"}
+
 class StageMid(nn.Module):
 
-    def __init__(self, n_embd=384, n_head=6, block_size=256, dropout=0.2, n_layer=1):
+    def __init__(self, n_embd=384, n_head=6, block_size=256, dropout=0.2, n_layer=1, compile_mode=None, autocast=False,
+                 cuda_graph=False):
         super().__init__()
         self.n_embd = n_embd
         self.n_head = n_head
         self.block_size = block_size
         self.dropout = dropout
+        assert compile_mode is None or compile_mode in _COMPILE_MODES, \
+            "compile_mode must be one of %s" % list(_COMPILE_MODES)
+        self.compile_mode = compile_mode
+        # the blocks run in bf16 on the GPU, the weights stay in fp32
+        self.autocast = autocast
+        # eval forward passes without autograd (validation) are replayed from
+        # a CUDA graph, capturing the forward alone would break the backward
+        assert not (cuda_graph and compile_mode is not None), "cuda_graph captures the eager blocks"
+        self.cuda_graph = cuda_graph
+        self._graph = None
+        self._static_in = None
+        self._static_out = None
         self.blocks = nn.Sequential(*[Block(n_embd, n_head, dropout, block_size) for _ in range(n_layer)])
+        self._compiled = False
 
         # better init, not covered in the original GPT video, but important, will cover in followup video
-        self.apply(self._init_weights)
+        self._init_weights()
+
+    @torch.no_grad()
+    def _init_weights(self):
+        # same distribution as applying it module by module (but not the same
+        # weights for a given seed), the stack has a lot of Linears: draw all
+        # their weights at once and zero all the biases with one multi-tensor
+        # kernel
+        weights = []
+        biases = []
+        for module in self.modules():
+            if isinstance(module, nn.Linear):
+                weights.append(module.weight)
+                if module.bias is not None:
+                    biases.append(module.bias)
+            elif isinstance(module, nn.Embedding):
+                weights.append(module.weight)
+        if len(weights) > 0:
+            flat = torch.empty(sum(weight.numel() for weight in weights),
+                               dtype=weights[0].dtype, device=weights[0].device).normal_(mean=0.0, std=0.02)
+            torch._foreach_copy_(weights, torch._utils._unflatten_dense_tensors(flat, weights))
+        if len(biases) > 0:
+            torch._foreach_zero_(biases)
+
+    def _compile_blocks(self):
+        mode = _COMPILE_MODES[self.compile_mode]
+        if self.compile_mode == "max-autotune":
+            # compile the whole stack so that inductor autotunes every GEMM of
+            # the stage
+            self.blocks.compile(mode=mode, dynamic=False)
+        else:
+            # regional compilation: every Block has the same code, so the compiled
+            # graph is reused across the stack. nn.Module.compile keeps state_dict keys.
+            for block in self.blocks:
+                block.compile(mode=mode, fullgraph=True, dynamic=False)
+        self._compiled = True
+
+    def warmup(self, batch_size):
+        """Runs a dummy forward and backward so that compilation (and autotuning)
+        does not land in the first training microbatch. The RNG state is
+        restored afterwards and no gradient is accumulated into the weights."""
+        param = next(self.parameters())
+        with torch.random.fork_rng(devices=[param.device]):
+            x = torch.zeros(batch_size, self.block_size, self.n_embd, dtype=param.dtype, device=param.device,
+                            requires_grad=True)
+            torch.autograd.grad(self(x).sum(), x)
+
+    def _forward_blocks(self, x):
+        # the residual stream stays in fp32, only the matmuls and the
+        # attention inside the blocks run in bf16. The weight cast cache is
+        # disabled since it is not allowed while capturing a CUDA graph.
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16,
+                            enabled=self.autocast and x.is_cuda, cache_enabled=False):
+            return self.blocks(x)
 
-    def _init_weights(self, module):
-        if isinstance(module, nn.Linear):
-            nn.init.normal_(module.weight, mean=0.0, std=0.02)
-            if module.bias is not None:
-                nn.init.zeros_(module.bias)
-        elif isinstance(module, nn.Embedding):
-            nn.init.normal_(module.weight, mean=0.0, std=0.02)
+    def _forward_graph(self, input0):
+        if self._graph is None:
+            self._static_in = input0.clone()
+            # warm up on a side stream before capture, as required by CUDA graphs
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._forward_blocks(self._static_in)
+            torch.cuda.current_stream().wait_stream(stream)
+            self._graph = torch.cuda.CUDAGraph()
+            # the send/recv helper threads keep copying and allocating on their
+            # own streams during validation, only this thread is captured
+            with torch.cuda.graph(self._graph, capture_error_mode="thread_local"):
+                self._static_out = self._forward_blocks(self._static_in)
+        elif input0.shape != self._static_in.shape:
+            # e.g. a smaller last batch, the graph only replays the captured shape
+            return self._forward_blocks(input0)
+        # the weights are updated in place, so the graph always sees the latest ones
+        self._static_in.copy_(input0)
+        self._graph.replay()
+        # the output is overwritten on the next replay, but it is sent to the
+        # next stage asynchronously
+        return self._static_out.clone()
 
     def forward(self, input0):
-        x = input0.clone()
-        x = self.blocks(x) # (B,T,C)
+        # shape inference runs the stages on CPU, only compile once on the GPU
+        if self.compile_mode is not None and not self._compiled and input0.is_cuda:
+            self._compile_blocks()
+        if self.cuda_graph and input0.is_cuda and not self.training and not torch.is_grad_enabled():
+            return self._forward_graph(input0)
+        x = self._forward_blocks(input0) # (B,T,C)
 
         return x
     
\ No newline at end of file
@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 class Head(nn.Module):
-    """ one head of self-attention """
+    """ one head of self-attention (MultiHeadAttention only uses its weights) """
 
     def __init__(self, head_size, dropout, n_embd, block_size):
         super().__init__()
@@ -40,7 +40,17 @@ class MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
 
     def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
+        B,T,C = x.shape
+        nh = len(self.heads)
+        # batch the heads into a single fused attention call (flash /
+        # memory-efficient kernels need (B, n_head, T, hs) inputs), one GEMM
+        # per projection with the weights of the heads concatenated
+        k = F.linear(x, torch.cat([h.key.weight for h in self.heads])).view(B, T, nh, -1).transpose(1, 2)   # (B,nh,T,hs)
+        q = F.linear(x, torch.cat([h.query.weight for h in self.heads])).view(B, T, nh, -1).transpose(1, 2) # (B,nh,T,hs)
+        v = F.linear(x, torch.cat([h.value.weight for h in self.heads])).view(B, T, nh, -1).transpose(1, 2) # (B,nh,T,hs)
+        dropout_p = self.heads[0].dropout.p if self.training else 0.0
+        out = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True) # (B,nh,T,hs)
+        out = out.transpose(1, 2).reshape(B, T, -1) # same layout as concatenating the heads
         out = self.dropout(self.proj(out))
         return out
 
@@ -2,10 +2,13 @@
 # Licensed under the MIT license.
 
 import torch
+import torch.distributed as dist
 import torch.optim
-import time
 import os
 import math
+import queue
+import numpy as np
+import threading
 from collections import deque  # Efficient ring buffer implementation.
 import torch.nn.functional as F
 class Version:
@@ -24,12 +27,15 @@ class OptimizerWithWeightStashing(torch.optim.Optimizer):
     Arguments:
         - optim_name: the name of optimizer, required to create the corresponding
                       base_optimizer (torch.optim.{optim_name}).
+        - stash_buffers: substrings of the names of the buffers to stash along
+                         with the parameters, the other buffers are not stashed.
         - optimizer_args: the keyword arguments passed to base_optimizer.
     """
 
     def __init__(self, optim_name, modules, master_parameters, model_parameters,
                  loss_scale, num_versions, verbose_freq=0, macrobatch=False,
-                 clip_grad=None, save_dir=None, stash_to_cpu=False, **optimizer_args):
+                 clip_grad=None, save_dir=None, stash_to_cpu=False, stash_dtype=None,
+                 stash_group=None, stash_buffers=(), **optimizer_args):
         self.modules = modules
         self.master_parameters = master_parameters
         self.model_parameters = model_parameters  # model_parameters is None if not fp16.
@@ -37,6 +43,26 @@ class OptimizerWithWeightStashing(torch.optim.Optimizer):
         self.clip_grad = clip_grad
         self.save_dir = save_dir
         self.stash_to_cpu = stash_to_cpu
+        # Floating point weights are stashed in stash_dtype (e.g. torch.bfloat16)
+        # if given, in their own dtype otherwise.
+        self.stash_dtype = stash_dtype
+        self.stash_buffers = stash_buffers
+        # Weights stashed to CPU or disk go through pinned host memory.
+        self.pinned_stash = stash_to_cpu or save_dir is not None
+        # The stash is captured on a side stream so that the copies overlap
+        # with the optimizer step and the next forward pass.
+        self.stash_stream = torch.cuda.Stream()
+        # Across the data parallel ranks of stash_group, each rank stashes
+        # 1/world_size of every version, the version to load is all-gathered.
+        self.stash_group = stash_group
+        self.shard_rank = 0
+        self.shard_world = 1
+        if stash_group is not None:
+            self.shard_rank = dist.get_rank(group=stash_group)
+            self.shard_world = dist.get_world_size(group=stash_group)
+        self.sharded = self.shard_world > 1
+        if self.sharded:
+            assert not self.pinned_stash, "the sharded stash is kept on the device"
         # Only need at most 2 versions if using macrobatching.
         if macrobatch:
             num_versions = min(2, num_versions)
@@ -45,10 +71,30 @@ class OptimizerWithWeightStashing(torch.optim.Optimizer):
         if len(self.master_parameters) == 0:
             print("Warning: no parameter groups to optimize")
         else:
+            if optim_name in ("Adam", "AdamW", "SGD") and all(p.is_cuda for p in master_parameters):
+                # fused kernels, which also unscale the gradients in the update
+                optimizer_args.setdefault("fused", True)
             self.base_optimizer = getattr(torch.optim, optim_name)(
                     master_parameters, **optimizer_args)
         self.latest_version = Version()
         self.current_version = Version()
+        # The tensors to stash are resolved once, they stay valid as the
+        # weights are updated in place.
+        self.stash_tensors = []
+        self.mask_keys = []
+        for module in self.modules:
+            tensors, mask_keys = self._classify(module)
+            self.stash_tensors.append(tensors)
+            self.mask_keys.append(mask_keys)
+        if self.save_dir is not None:
+            # Stashed versions are written to disk by a helper daemon thread so
+            # that the writes overlap with the next forward pass.
+            self.save_queue = queue.Queue(maxsize=2)
+            self.saved_events = {}
+            self.last_saved = None
+            self.save_error = None
+            threading.Thread(target=self._saver_loop, daemon=True).start()
+        self._allocate_stash()
         self.initialize_queue()
         self.verbose_freq = verbose_freq
         self.batch_counter = 0
@@ -59,6 +105,16 @@ class OptimizerWithWeightStashing(torch.optim.Optimizer):
         else:
             self.update_interval = 1
 
+        # Gradients are divided by the update interval, and by the loss scale
+        # when training in fp16. A fused base optimizer does it inside its
+        # update through grad_scale (the hook used by torch.amp.GradScaler).
+        self.grad_scale = float(self.update_interval)
+        if self.model_parameters is not None:
+            self.grad_scale *= self.loss_scale
+        self.grad_scale_tensor = None
+        if self.base_optimizer is not None:
+            self.grad_scale_tensor = torch.tensor(self.grad_scale, device=self.master_parameters[0].device)
+
     def __getattr__(self, key):
         """Relay the unknown key to base_optimizer."""
         if self.base_optimizer is None: # handle empty parameter list case
@@ -70,94 +126,305 @@ class OptimizerWithWeightStashing(torch.optim.Optimizer):
                 return None
         return getattr(self.base_optimizer, key)
     
+    def _saver_loop(self):
+        while True:
+            slot, flats, ready, saved = self.save_queue.get()
+            try:
+                if ready is not None:
+                    # wait for the D2H copies of the stash
+                    ready.synchronize()
+                # raw bytes, every version has the same layout
+                for flat, offset in zip(flats, self.stash_offsets):
+                    if flat is not None:
+                        self.stash_file[slot, offset:offset + flat.numel() * flat.element_size()] = \
+                            flat.view(torch.uint8).numpy()
+            except Exception as e:
+                # keep draining the queue so that _save does not block, the
+                # error is raised on the training thread
+                self.save_error = e
+            finally:
+                saved.set()
+
+    def _save(self, state_dicts, version, slot):
+        ready = torch.cuda.Event()
+        ready.record(self.stash_stream)
+        saved = threading.Event()
+        self.saved_events[slot] = saved
+        self.last_saved = saved
+        # masks may change shape, they stay in memory
+        self.stash_masks[slot] = [dict(masks) for _, masks in state_dicts]
+        self.stash_versions[slot] = version
+        self.save_queue.put((slot, [flat for flat, _ in state_dicts], ready, saved))
+
+    def _check_saved(self):
+        if self.save_error is not None:
+            raise RuntimeError("Writing the weight stash to disk failed") from self.save_error
+
+    def _wait_saved(self):
+        if self.last_saved is not None:
+            self.last_saved.wait()
+        self._check_saved()
+
+    def _next_slot(self):
+        # the slot of the version about to be evicted is reused
+        return self.queue[0] if len(self.queue) == self.queue.maxlen else len(self.queue)
+
     def append_to_queue(self, data):
         state_dicts, version = data
+        slot = self._next_slot()
         if self.save_dir is not None:
-            # only keep the filename in memory and load it when needed
-            fname = os.path.join(self.save_dir, f"version_{version.version % self.num_versions}.pth.tar")
-            d = {"state_dicts": state_dicts, "version": version}
-            torch.save(d, fname)
-            self.queue.append(fname)
+            # only keep the slot of the stash file in memory and read it when needed
+            self._save(state_dicts, version, slot)
         else:
-            self.queue.append((state_dicts, version))
+            self.ring[slot] = state_dicts
+            self.ring_versions[slot] = version
+        self.queue.append(slot)
 
     def get_from_queue(self, index):
+        slot = self.queue[index]
         if self.save_dir is not None:
-            fname = self.queue[index]
-            d = torch.load(fname)
-            return d["state_dicts"], d["version"]
+            self.saved_events[slot].wait()
+            self._check_saved()
+            state_dicts = []
+            for tensors, offset, masks in zip(self.stash_tensors, self.stash_offsets, self.stash_masks[slot]):
+                flat = None
+                if len(tensors) > 0:
+                    dtype = self.stash_dtype if self.stash_dtype is not None else tensors[0].dtype
+                    nbytes = sum(tensor.numel() for tensor in tensors) * dtype.itemsize
+                    # zero-copy view of the memory-mapped file
+                    flat = torch.from_numpy(self.stash_file[slot, offset:offset + nbytes]).view(dtype)
+                state_dicts.append((flat, masks))
+            return state_dicts, self.stash_versions[slot]
         else:
-            return self.queue[index]
+            return self.ring[slot], self.ring_versions[slot]
 
     def insert_to_queue(self, data, index): # replaces the data at index with the new data
         state_dicts, version = data
+        slot = self.queue[index]
         if self.save_dir is not None:
-            fname = os.path.join(self.save_dir, f"version_{index}.pth.tar")
-            d = {"state_dicts": state_dicts, "version": version}
-            torch.save(d, fname)
-            self.queue[index] = (fname)
+            self._save(state_dicts, version, slot)
         else:
-            self.queue[index] = ((state_dicts, version))
+            self.ring[slot] = state_dicts
+            self.ring_versions[slot] = version
+
+    def _buffer_needed(self, name):
+        return any(pattern in name for pattern in self.stash_buffers)
+
+    def _classify(self, module):
+        """Splits the parameters and buffers of module into the tensors that are
+        flattened into the stash and the masks, along with the module owning
+        each mask. Buffers not in stash_buffers (e.g. the causal tril of the
+        attention heads) are constant or accumulate normally, they are not stashed."""
+        named_tensors = list(module.named_parameters()) + \
+            [(name, buffer) for name, buffer in module.named_buffers()
+             if "mask" in name or self._buffer_needed(name)]
+        tensors = []
+        mask_keys = []
+        for key, tensor in named_tensors:
+            if "mask" in key:
+                # mask might have a different shape, so it is stashed on its
+                # own and assigned back to its module.
+                attribute_names = key.split(".")
+                parent = module
+                for attribute_name in attribute_names[:-1]:
+                    parent = getattr(parent, attribute_name)
+                mask_keys.append((key, parent, attribute_names[-1]))
+            elif "running_" not in key and tensor.is_floating_point():
+                # Running_mean and running_var for batchnorm layers (and other
+                # non floating point buffers) accumulate normally.
+                tensors.append(tensor.data)
+        return tensors, mask_keys
+
+    def _allocate_stash(self):
+        """Allocates the stash once, initialize_queue refills it in place."""
+        # Each module's stashed tensors are flattened into one contiguous
+        # buffer, so a version is saved and restored with a single copy.
+        # Device-side buffers to gather into before a D2H copy, or to slice
+        # the shard out of and to all-gather into (padded to world_size).
+        if self.sharded:
+            self.staging_buffers = [self._empty_flat(tensors, dtype=self.stash_dtype,
+                                                     numel=self._shard_numel(tensors) * self.shard_world)
+                                    for tensors in self.stash_tensors]
+        else:
+            self.staging_buffers = [self._empty_flat(tensors) if self.pinned_stash else None
+                                    for tensors in self.stash_tensors]
+        # A reduced precision or sharded stash would truncate or all-gather the
+        # latest weights when they are restored, keep them on the device at
+        # full precision. This costs one parameter-sized device buffer, but
+        # the snapshot is a device to device copy that never crosses PCIe.
+        self.live_state_dicts = None
+        if self.stash_dtype is not None or self.sharded:
+            self.live_state_dicts = [(self._empty_flat(tensors), {}) for tensors in self.stash_tensors]
+        if self.save_dir is not None:
+            # The versions are kept in a raw memory-mapped file of
+            # num_versions slots, each slot holds the flat buffers of all
+            # modules back to back. The versions of the slots stay in memory.
+            self.write_state_dicts = [(self._empty_flat(tensors, pinned=True, dtype=self.stash_dtype), {})
+                                      for tensors in self.stash_tensors]
+            self.stash_offsets = []
+            nbytes = 0
+            for flat, _ in self.write_state_dicts:
+                self.stash_offsets.append(nbytes)
+                nbytes += flat.numel() * flat.element_size() if flat is not None else 0
+            self.stash_file = np.memmap(os.path.join(self.save_dir, "weight_stash.bin"), dtype=np.uint8,
+                                        mode="w+", shape=(self.num_versions, max(nbytes, 1)))
+        else:
+            # Ring of num_versions slots, the queue holds the slot of each
+            # version from the oldest to the latest.
+            self.ring = [[(self._empty_flat(tensors, pinned=self.pinned_stash, dtype=self.stash_dtype,
+                                            numel=self._shard_numel(tensors)), {})
+                          for tensors in self.stash_tensors]
+                         for _ in range(self.num_versions)]
+            self.ring_versions = [None] * self.num_versions
+
+    def _clone_masks(self, state_dicts):
+        return [(flat, {key: mask.clone() for key, mask in masks.items()}) for flat, masks in state_dicts]
 
     def initialize_queue(self):
+        # the previous buffers may still be written by the stash stream
+        self._wait_all_gather()
+        self.all_gather_handles = []
+        torch.cuda.current_stream().wait_stream(self.stash_stream)
         self.queue = deque(maxlen=self.num_versions)
-        for i in range(self.num_versions):
-            self.append_to_queue(self.get_params(clone=True))
-        self.buffered_state_dicts = self.get_from_queue(0)[0]
-
-    def get_params(self, clone):
-        if clone:
-            state_dicts = []
-            for module in self.modules:
-                state_dict = module.state_dict()
-                for key in state_dict:
-                    state_dict[key] = state_dict[key].clone().cpu() if self.stash_to_cpu else state_dict[key].clone()
-                state_dicts.append(state_dict)
+        # A single snapshot of the weights is copied into every slot.
+        if self.save_dir is not None:
+            self._wait_saved()
+            self.stash_masks = {}
+            self.stash_versions = {}
+            state_dicts, version = self.get_params()
+            for slot in range(self.num_versions):
+                # each slot is written to disk from the same pinned buffers
+                self.append_to_queue((self._clone_masks(state_dicts) if slot > 0 else state_dicts, version))
         else:
-            for i, module in enumerate(self.modules):
-                state_dict = module.state_dict()
-                for key in state_dict:
-                    # Running_mean and running_var for batchnorm layers should
-                    # accumulate normally.
-                    if "running_" in key:
-                        continue
-                    if "mask" in key:
-                        self.buffered_state_dicts[i][key] = state_dict[key].clone().cpu() if self.stash_to_cpu else state_dict[key].clone()
+            self.buffered_state_dicts = self.ring[0]
+            state_dicts, version = self.get_params()
+            if self.pinned_stash:
+                # the host to host copies need the snapshot on the host
+                self.stash_stream.synchronize()
+            for slot in range(1, self.num_versions):
+                for (flat, masks), (source, source_masks) in zip(self.ring[slot], state_dicts):
+                    if flat is not None:
+                        with torch.cuda.stream(self.stash_stream):
+                            flat.copy_(source, non_blocking=True)
+                    masks.clear()
+                    masks.update({key: mask.clone() for key, mask in source_masks.items()})
+            for slot in range(self.num_versions):
+                self.append_to_queue((self.ring[slot], version))
+            self.buffered_state_dicts = self.get_from_queue(0)[0]
+        if self.sharded and self.num_versions > 1:
+            self._all_gather_oldest()
+
+    def _shard_numel(self, tensors):
+        numel = sum(tensor.numel() for tensor in tensors)
+        return (numel + self.shard_world - 1) // self.shard_world
+
+    def _empty_flat(self, tensors, pinned=False, dtype=None, numel=None):
+        if len(tensors) == 0:
+            return None
+        if numel is None:
+            numel = sum(tensor.numel() for tensor in tensors)
+        dtype = dtype if dtype is not None else tensors[0].dtype
+        if pinned:
+            return torch.empty(numel, dtype=dtype, pin_memory=True)
+        return torch.empty(numel, dtype=dtype, device=tensors[0].device)
+
+    def get_params(self):
+        if self.save_dir is not None:
+            # gather into the write buffers once the previous version is on disk
+            self._wait_saved()
+            self.buffered_state_dicts = self.write_state_dicts
+        if self.sharded:
+            # the staging buffers and the oldest shard may still be all-gathered
+            self._wait_all_gather()
+        self._gather(self.buffered_state_dicts, shard=self.sharded)
+        return self.buffered_state_dicts, self.latest_version
+
+    def _gather(self, state_dicts, shard=False):
+        """Copies the current weights of the modules into state_dicts, on the
+        stash stream. With shard, only this rank's slice of them is copied."""
+        self.stash_stream.wait_stream(torch.cuda.current_stream())
+        for i, (flat, masks) in enumerate(state_dicts):
+            for key, parent, attribute_name in self.mask_keys[i]:
+                mask = getattr(parent, attribute_name)
+                masks[key] = mask.clone().cpu() if self.stash_to_cpu else mask.clone()
+            if flat is None:
+                continue
+            tensors = [tensor.view(-1) for tensor in self.stash_tensors[i]]
+            with torch.cuda.stream(self.stash_stream):
+                if shard:
+                    staging = self.staging_buffers[i]
+                    full = staging[:sum(tensor.numel() for tensor in tensors)]
+                    if full.dtype != tensors[0].dtype:
+                        full.copy_(torch.cat(tensors))
                     else:
-                        self.buffered_state_dicts[i][key].copy_(state_dict[key].cpu() if self.stash_to_cpu else state_dict[key])
-            state_dicts = self.buffered_state_dicts
-        return state_dicts, self.latest_version
+                        torch.cat(tensors, out=full)
+                    flat.copy_(staging[self.shard_rank * flat.numel():(self.shard_rank + 1) * flat.numel()])
+                elif not flat.is_cuda:
+                    torch.cat(tensors, out=self.staging_buffers[i])
+                    flat.copy_(self.staging_buffers[i], non_blocking=True)
+                elif flat.dtype != tensors[0].dtype:
+                    flat.copy_(torch.cat(tensors))
+                else:
+                    torch.cat(tensors, out=flat)
 
     def set_params(self, state_dicts, version):
-        for (state_dict, module) in zip(state_dicts, self.modules):
-            cur_state_dict = module.state_dict()
-            for key in state_dict:
-                # Don't update running_mean and running_var; these should
-                # accumulate normally.
-                # mask might have a different shape, so don't copy it to
-                # the module this way.
-                if "running_" in key or "mask" in key:
-                    state_dict[key] = cur_state_dict[key].cuda() if self.stash_to_cpu else cur_state_dict[key]
-            module.load_state_dict(state_dict)
+        # the stash must be captured before it is read back, or before the
+        # weights it is copied from are overwritten
+        torch.cuda.current_stream().wait_stream(self.stash_stream)
+        for i, (flat, masks) in enumerate(state_dicts):
+            tensors = self.stash_tensors[i]
+            if flat is not None:
+                if not flat.is_cuda:
+                    # H2D is asynchronous since the stash is pinned
+                    flat = self.staging_buffers[i].copy_(flat, non_blocking=True)
+                elif flat.dtype != tensors[0].dtype:
+                    flat = flat.to(tensors[0].dtype)
+                torch._foreach_copy_(tensors, torch._utils._unflatten_dense_tensors(flat, tensors))
 
             # Load the mask.
-            for key in state_dict:
-                if "mask" in key:
-                    attribute_names = key.split(".")
-                    attribute = module
-                    for attribute_name in attribute_names:
-                        attribute = getattr(attribute, attribute_name)
-                    # NOTE: Do we need to clone here?
-                    attribute = state_dict[key].cuda() if self.stash_to_cpu else state_dict[key]
+            for key, parent, attribute_name in self.mask_keys[i]:
+                setattr(parent, attribute_name, masks[key].cuda() if self.stash_to_cpu else masks[key])
         self.current_version = version
 
+    def _all_gather_oldest(self):
+        """Starts all-gathering the oldest version into the staging buffers.
+        It is issued on the stash stream, after the version is captured, and
+        overlaps with the next forward pass."""
+        state_dicts, _ = self.get_from_queue(0)
+        self.all_gather_handles = []
+        with torch.cuda.stream(self.stash_stream):
+            for (flat, _), staging in zip(state_dicts, self.staging_buffers):
+                if flat is not None:
+                    # one collective for all the tensors of the module
+                    self.all_gather_handles.append(dist.all_gather_into_tensor(
+                        staging, flat, group=self.stash_group, async_op=True))
+
+    def _wait_all_gather(self):
+        for handle in getattr(self, "all_gather_handles", []):
+            handle.wait()
+
     def load_old_params(self):
         if self.num_versions > 1:
-            self.set_params(*self.get_from_queue(0))
+            if self.live_state_dicts is not None:
+                self._gather(self.live_state_dicts)
+            if self.sharded:
+                self._wait_all_gather()
+                state_dicts, version = self.get_from_queue(0)
+                state_dicts = [(staging[:sum(tensor.numel() for tensor in tensors)] if flat is not None else None,
+                                masks)
+                               for (flat, masks), staging, tensors
+                               in zip(state_dicts, self.staging_buffers, self.stash_tensors)]
+                self.set_params(state_dicts, version)
+            else:
+                self.set_params(*self.get_from_queue(0))
 
     def load_new_params(self):
         if self.num_versions > 1:
-            self.set_params(*self.get_from_queue(-1))
+            if self.live_state_dicts is not None:
+                # the latest version is the one load_old_params replaced
+                self.set_params(self.live_state_dicts, self.latest_version)
+            else:
+                self.set_params(*self.get_from_queue(-1))
 
     def zero_grad(self):
         if self.base_optimizer is not None and self.batch_counter % self.update_interval == 0:
@@ -177,24 +444,34 @@ class OptimizerWithWeightStashing(torch.optim.Optimizer):
 
         log_timing = self.verbose_freq > 0 and self.batch_counter % self.verbose_freq == 0
         if log_timing:
-            start_time = time.time()
+            # CUDA events time the step on the device without a host sync
+            start_event = torch.cuda.Event(enable_timing=True)
+            end_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
         if self.model_parameters is not None:
             import apex.fp16_utils as fp16_utils
             fp16_utils.model_grads_to_master_grads(self.model_parameters,
                                                    self.master_parameters)
+
+        clip_grad = self.clip_grad
+        # param_groups may come from a checkpoint, check them on every step
+        fused = self.base_optimizer is not None and bool(self.param_groups[0].get("fused"))
+        if self.base_optimizer is not None:
+            self.base_optimizer.grad_scale = self.grad_scale_tensor if fused and self.grad_scale != 1.0 else None
+        if fused:
+            # the gradients are still scaled, so is their norm
+            clip_grad = clip_grad * self.grad_scale if clip_grad is not None else None
+        else:
             # TODO: This division might not be in the right place, given that
             # scaling happens right after. Look into this if problems arise.
-            if self.loss_scale != 1.0:
-                for parameter in self.master_parameters:
-                    parameter.grad.data = parameter.grad.data / self.loss_scale
-
-        for p in self.param_groups[0]['params']:
-            if p.grad is not None:
-                p.grad.div_(self.update_interval)
+            # one multi-tensor kernel instead of a division per parameter
+            grads = [p.grad for p in self.param_groups[0]['params'] if p.grad is not None]
+            if self.grad_scale != 1.0 and len(grads) > 0:
+                torch._foreach_div_(grads, self.grad_scale)
 
         # clip gradient norm
-        if self.clip_grad is not None:
-            torch.nn.utils.clip_grad_norm_(self.param_groups[0]['params'], self.clip_grad)
+        if clip_grad is not None:
+            torch.nn.utils.clip_grad_norm_(self.param_groups[0]['params'], clip_grad)
 
         loss = self.base_optimizer.step() if self.base_optimizer is not None else None
         if self.model_parameters is not None:
@@ -203,10 +480,16 @@ class OptimizerWithWeightStashing(torch.optim.Optimizer):
                                                      self.master_parameters)
         self.latest_version = self.latest_version.incr()
         if self.num_versions > 1:
-            self.buffered_state_dicts = self.get_from_queue(0)[0]
-            self.append_to_queue(self.get_params(clone=False))
+            if self.save_dir is None:
+                # reuse the buffers of the version about to be evicted
+                self.buffered_state_dicts = self.get_from_queue(0)[0]
+            self.append_to_queue(self.get_params())
+            if self.sharded:
+                self._all_gather_oldest()
 
         if log_timing:
-            print("Optimizer step took: %.3f" % (time.time() - start_time))
+            end_event.record()
+            end_event.synchronize()
+            print("Optimizer step took: %.3f" % (start_event.elapsed_time(end_event) / 1000))
         self.batch_counter += 1
         return loss
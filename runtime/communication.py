@@ -585,13 +585,15 @@ class CommunicationHandler(object):
         if backward:
             index = (backward_minibatch_id + self.rank_in_stage) % \
                 len(self.backward_receive_queues[tensor_name])
-            tensor = self.backward_receive_queues[tensor_name][
+            tensor, event = self.backward_receive_queues[tensor_name][
                 index].remove()
+            _wait_event(tensor, event)
             return tensor
         else:
             index = self.get_messaging_index(sending=False)
-            tensor = self.forward_receive_queues[tensor_name][
+            tensor, event = self.forward_receive_queues[tensor_name][
                 index].remove()
+            _wait_event(tensor, event)
             if tensor.dtype == torch.float32:
                 tensor = tensor.requires_grad_()
             return tensor
@@ -601,23 +603,27 @@ class CommunicationHandler(object):
         if backward:
             index = self.get_messaging_index(sending=True)
             dst_rank = self.receive_ranks[tensor_name][index]
-            self.backward_send_queues[tensor_name][index].add(tensor)
+            self.backward_send_queues[tensor_name][index].add(
+                tensor, _record_event())
         else:
             index = (forward_minibatch_id + self.rank_in_stage) % \
                 len(self.send_ranks[tensor_name])
-            self.forward_send_queues[tensor_name][index].add(tensor)
+            self.forward_send_queues[tensor_name][index].add(
+                tensor, _record_event())
 
 def recv_helper_thread(queue, counter, local_rank, tensor_name,
                        src_rank, tag, tensor_shape, dtype,
                        sub_process_group, num_iterations):
     torch.cuda.set_device(local_rank)
     # This method is to be executed from a helper daemon thread.
-    for i in range(num_iterations):
-        tensor = _recv(
-            tensor_name, src_rank, tensor_shape=tensor_shape,
-            dtype=dtype, tag=tag,
-            sub_process_group=sub_process_group)
-        queue.add(tensor)
+    # Runs on its own stream, the consumer waits on the event of each tensor.
+    with torch.cuda.stream(torch.cuda.Stream()):
+        for i in range(num_iterations):
+            tensor = _recv(
+                tensor_name, src_rank, tensor_shape=tensor_shape,
+                dtype=dtype, tag=tag,
+                sub_process_group=sub_process_group)
+            queue.add(tensor, _record_event())
     counter.decrement()
 
 def send_helper_thread(queue, counter, local_rank, tensor_name,
@@ -625,13 +631,38 @@ def send_helper_thread(queue, counter, local_rank, tensor_name,
                        sub_process_group, num_iterations):
     torch.cuda.set_device(local_rank)
     # This method is to be executed from a helper daemon thread.
-    for i in range(num_iterations):
-        tensor = queue.remove()
-        _send(tensor, tensor_name, src_rank, dst_rank,
-              tag=tag,
-              sub_process_group=sub_process_group)
+    # Runs on its own stream, waiting on the event of each tensor.
+    with torch.cuda.stream(torch.cuda.Stream()):
+        for i in range(num_iterations):
+            tensor, event = queue.remove()
+            _wait_event(tensor, event)
+            _send(tensor, tensor_name, src_rank, dst_rank,
+                  tag=tag,
+                  sub_process_group=sub_process_group)
     counter.decrement()
 
+def _record_event():
+    """
+    Records an event on the current stream, marking when a tensor handed to
+    another thread is ready.
+    """
+    event = torch.cuda.Event()
+    event.record()
+    return event
+
+def _wait_event(tensor, event):
+    """
+    Makes the current stream wait for a tensor received from another thread.
+
+    The tensor may have been allocated on the other thread's stream, so its
+    memory is also marked as in use by the current stream.
+    """
+    if event is None:
+        return
+    stream = torch.cuda.current_stream()
+    stream.wait_event(event)
+    tensor.record_stream(stream)
+
 def _recv(tensor_name, src_rank, tensor_shape=None, dtype=torch.float32,
           tensor=None, tag=None, sub_process_group=None):
     """
@@ -244,6 +244,7 @@ class StageRuntime:
             group = groups[self.stage]
         else:
             group = None
+        self.group = group
 
         # self.modules_with_dependencies contains a list of PyTorch
         # modules, along with a list of user-defined input and output
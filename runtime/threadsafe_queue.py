@@ -1,26 +1,31 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import collections
 import threading
 
 """
 Implementation of a thread-safe queue with one producer and one consumer.
+
+deque.append and deque.popleft are atomic, so the only synchronization
+needed is an event to wake up the consumer when the queue is empty.
+
+Tensors are queued along with a CUDA event recorded on the producer's
+stream, the consumer makes its own stream wait on it.
 """
 class Queue:
     def __init__(self):
-        self.queue = []
-        self.cv = threading.Condition()
+        self.queue = collections.deque()
+        self.event = threading.Event()
 
-    def add(self, tensor):
-        self.cv.acquire()
-        self.queue.append(tensor)
-        self.cv.notify()
-        self.cv.release()
+    def add(self, tensor, event=None):
+        self.queue.append((tensor, event))
+        self.event.set()
 
     def remove(self):
-        self.cv.acquire()
-        while len(self.queue) == 0:
-            self.cv.wait()
-        tensor = self.queue.pop(0)
-        self.cv.release()
-        return tensor
+        while True:
+            try:
+                return self.queue.popleft()
+            except IndexError:
+                self.event.wait()
+                self.event.clear()